@@ -1,7 +1,12 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
 from functools import reduce
-from itertools import islice
-from typing import Set, Optional, Iterable, Union, Any, Dict
+from importlib.util import find_spec
+from itertools import repeat
+from operator import attrgetter, or_
+from threading import BoundedSemaphore, Lock
+from typing import Set, FrozenSet, Optional, Iterable, Iterator, Union, Any, Dict, List, Tuple, Callable
 
 from chatnoir_api import Index, Result, Slop, ExplainedResult
 from chatnoir_api.model import SearchMethod
@@ -11,14 +16,146 @@ from chatnoir_api.v1 import (
 from chatnoir_api.defaults import (
     DEFAULT_INDEX, DEFAULT_SLOP, DEFAULT_RETRIES, DEFAULT_BACKOFF_SECONDS, DEFAULT_API_KEY, DEFAULT_SEARCH_METHOD
 )
-from pandas import DataFrame
-from pandas.core.groupby import DataFrameGroupBy
+from pandas import DataFrame, Series
 from pyterrier import Transformer
-from pyterrier.model import add_ranks
+from pyterrier.model import FIRST_RANK
 from tqdm import tqdm
 
 from chatnoir_pyterrier.feature import Feature
 
+
+# Known data types of result columns, to skip inferring them.
+_COLUMN_DTYPES: Dict[str, str] = {
+    "docno": "object",
+    "score": "float64",
+    "uuid": "object",
+    "trec_id": "object",
+    "warc_id": "object",
+    "index": "object",
+    "target_hostname": "object",
+    "target_uri": "object",
+    "cache_uri": "object",
+    "page_rank": "float64",
+    "spam_rank": "float64",
+    "title_highlighted": "object",
+    "title_text": "object",
+    "snippet_highlighted": "object",
+    "snippet_text": "object",
+    "explanation": "object",
+    "contents": "object",
+    "contents_plain": "object",
+    "text": "object",
+    "content_type": "object",
+    "language": "object",
+}
+
+# Pandas' string data type, backed by PyArrow if installed.
+_STRING_DTYPE: str = (
+    "string[pyarrow]"
+    if find_spec("pyarrow") is not None
+    else "string"
+)
+
+# Compact data types of result columns, to reduce memory usage.
+_COMPACT_COLUMN_DTYPES: Dict[str, str] = {
+    **_COLUMN_DTYPES,
+    "docno": _STRING_DTYPE,
+    "score": "float32",
+    "trec_id": _STRING_DTYPE,
+    "warc_id": _STRING_DTYPE,
+    "index": _STRING_DTYPE,
+    "target_hostname": _STRING_DTYPE,
+    "target_uri": _STRING_DTYPE,
+    "cache_uri": _STRING_DTYPE,
+    "page_rank": "float32",
+    "spam_rank": "float32",
+    "title_highlighted": _STRING_DTYPE,
+    "title_text": _STRING_DTYPE,
+    "snippet_highlighted": _STRING_DTYPE,
+    "snippet_text": _STRING_DTYPE,
+    "contents": _STRING_DTYPE,
+    "contents_plain": _STRING_DTYPE,
+    "text": _STRING_DTYPE,
+    "content_type": _STRING_DTYPE,
+    "language": _STRING_DTYPE,
+}
+
+def _explanation(result: Result) -> Any:
+    if not isinstance(result, ExplainedResult):
+        raise RuntimeError(f"Unexpected response type: {type(result)}, expected: {type(ExplainedResult)}")
+    return result.explanation
+
+
+def _contents(result: Result) -> Optional[str]:
+    try:
+        return result.cache_contents(plain=False)
+    except Exception:
+        return None
+
+
+def _contents_plain(result: Result) -> Optional[str]:
+    try:
+        return result.cache_contents(plain=True)
+    except Exception:
+        return None
+
+
+# Extractors that request the contents from ChatNoir's cache.
+_CONTENTS_EXTRACTORS: Tuple[Callable[[Result], Any], ...] = (
+    _contents,
+    _contents_plain,
+)
+
+
+# Result columns with their extractors, in the order they are added.
+_FEATURE_EXTRACTORS: List[Tuple[Feature, str, Callable[[Result], Any]]] = [
+    (Feature.UUID, "uuid", attrgetter("uuid")),
+    (Feature.TREC_ID, "trec_id", attrgetter("trec_id")),
+    (Feature.WARC_ID, "warc_id", attrgetter("warc_id")),
+    (Feature.INDEX, "index", attrgetter("index")),
+    (Feature.CRAWL_DATE, "crawl_date", attrgetter("crawl_date")),
+    (Feature.TARGET_HOSTNAME, "target_hostname", attrgetter("target_hostname")),
+    (Feature.TARGET_URI, "target_uri", attrgetter("target_uri")),
+    (Feature.CACHE_URI, "cache_uri", attrgetter("cache_uri")),
+    (Feature.PAGE_RANK, "page_rank", attrgetter("page_rank")),
+    (Feature.SPAM_RANK, "spam_rank", attrgetter("spam_rank")),
+    (Feature.TITLE_HIGHLIGHTED, "title_highlighted", attrgetter("title.html")),
+    (Feature.TITLE_TEXT, "title_text", attrgetter("title.text")),
+    (Feature.SNIPPET_HIGHLIGHTED, "snippet_highlighted", attrgetter("snippet.html")),
+    (Feature.SNIPPET_TEXT, "snippet_text", attrgetter("snippet.text")),
+    (Feature.EXPLANATION, "explanation", _explanation),
+    (Feature.CONTENTS, "contents", _contents),
+    (Feature.CONTENTS_PLAIN, "contents_plain", _contents_plain),
+    (Feature.CONTENT_TYPE, "content_type", attrgetter("content_type")),
+    (Feature.LANGUAGE, "language", attrgetter("language")),
+]
+
+
+def _fetch(
+    requests: BoundedSemaphore,
+    extract: Callable[[Result], Any],
+    result: Result,
+) -> Any:
+    with requests:
+        return extract(result)
+
+
+def _feature_extractors(
+    features: Feature,
+) -> List[Tuple[str, Callable[[Result], Any]]]:
+    # Compare plain integer bit masks instead of flags.
+    mask: int = features.value
+    return [
+        ("docno", attrgetter("trec_id")),
+        ("score", attrgetter("score")),
+        *(
+            (column, extract)
+            for feature, column, extract in _FEATURE_EXTRACTORS
+            if mask & feature.value
+        ),
+    ]
+
+
 @dataclass
 class ChatNoirRetrieve(Transformer):
     name = "ChatNoirRetrieve"
@@ -35,105 +172,136 @@ class ChatNoirRetrieve(Transformer):
     retries: int = DEFAULT_RETRIES
     backoff_seconds: float = DEFAULT_BACKOFF_SECONDS
     verbose: bool = False
+    max_workers: int = 10
+    cache_size: Optional[int] = 0
+    compact_dtypes: bool = False
     api_key: str = DEFAULT_API_KEY
     search_method: SearchMethod = DEFAULT_SEARCH_METHOD
 
-    def _merge_result(
-        self,
-        row: Dict[str, Any],
-        result: Union[
-            Result, ExplainedResult,
-        ]
-    ) -> Dict[str, Any]:
-        row = {
-            **row,
-            "docno": result.trec_id,
-            "score": result.score,
-        }
-        if Feature.UUID in self.features:
-            row["uuid"] = result.uuid
-        if Feature.TREC_ID in self.features:
-            row["trec_id"] = result.trec_id
-        if Feature.WARC_ID in self.features:
-            row["warc_id"] = result.warc_id
-        if Feature.INDEX in self.features:
-            row["index"] = result.index
-        if Feature.CRAWL_DATE in self.features:
-            row["crawl_date"] = result.crawl_date
-        if Feature.TARGET_HOSTNAME in self.features:
-            row["target_hostname"] = result.target_hostname
-        if Feature.TARGET_URI in self.features:
-            row["target_uri"] = result.target_uri
-        if Feature.CACHE_URI in self.features:
-            row["cache_uri"] = result.cache_uri
-        if Feature.PAGE_RANK in self.features:
-            row["page_rank"] = result.page_rank
-        if Feature.SPAM_RANK in self.features:
-            row["spam_rank"] = result.spam_rank
-        if Feature.TITLE_HIGHLIGHTED in self.features:
-            row["title_highlighted"] = result.title.html
-        if Feature.TITLE_TEXT in self.features:
-            row["title_text"] = result.title.text
-        if Feature.SNIPPET_HIGHLIGHTED in self.features:
-            row["snippet_highlighted"] = result.snippet.html
-        if Feature.SNIPPET_TEXT in self.features:
-            row["snippet_text"] = result.snippet.text
-        if Feature.EXPLANATION in self.features:
-            if not isinstance(result, ExplainedResult):
-                raise RuntimeError(f"Unexpected response type: {type(result)}, expected: {type(ExplainedResult)}")
-            row["explanation"] = result.explanation
-        if Feature.CONTENTS in self.features:
-            try:
-                row["contents"] = result.cache_contents(plain=False)
-            except Exception:
-                row["contents"] = None
-        if Feature.CONTENTS_PLAIN in self.features:
-            try:
-                row["text"] = row["contents_plain"] = result.cache_contents(plain=True)
-            except Exception:
-                row["text"] = row["contents_plain"] = None
-        if Feature.CONTENT_TYPE in self.features:
-            row["content_type"] = result.content_type
-        if Feature.LANGUAGE in self.features:
-            row["language"] = result.language
-        return row
-
-    def _transform_query(self, topic: DataFrame) -> DataFrame:
-        if len(topic.index) != 1:
-            raise RuntimeError("Can only transform one query at a time.")
+    def __post_init__(self) -> None:
+        self._init_cache()
+        self._precompute()
 
-        row: Dict[str, Any] = topic.to_dict(orient="records")[0]
-        query: str = row["query"]
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name == "cache_size" and "_cache" in self.__dict__:
+            # Drop cached results to respect the new size.
+            with self._cache_lock:
+                self._cache.clear()
+        # Keep precomputed state in sync when changing parameters later on.
+        if name in self.__dataclass_fields__ and "_extractors" in self.__dict__:
+            self._precompute()
 
-        page_size: int
-        if self.num_results is not None:
-            page_size = min(self.page_size, self.num_results)
+    def __getstate__(self) -> Dict[str, Any]:
+        # Neither share cached results with copies nor pickle them.
+        state = dict(self.__dict__)
+        state.pop("_cache", None)
+        state.pop("_cache_lock", None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def _init_cache(self) -> None:
+        self._cache_lock: Lock = Lock()
+        self._cache: "OrderedDict[Tuple[Tuple[Any, ...], str], Dict[str, List[Any]]]" = \
+            OrderedDict()
+
+    def _precompute(self) -> None:
+        self._index: Union[Index, FrozenSet[Index]]
+        if isinstance(self.index, Set):
+            self._index = frozenset(self.index)
         else:
-            page_size = self.page_size
+            self._index = self.index
 
-        features: Feature
+        self._features: Feature
         if isinstance(self.features, Set):
-            features = reduce(
-                lambda feature_a, feature_b: feature_a | feature_b,
-                self.features
-            )
+            self._features = reduce(or_, self.features, Feature.NONE)
+        else:
+            self._features = self.features
+
+        self._page_size: int
+        if self.num_results is not None:
+            self._page_size = min(self.page_size, self.num_results)
         else:
-            features = self.features
+            self._page_size = self.page_size
+
+        self._explain: bool = Feature.EXPLANATION in self._features
 
-        explain: bool = Feature.EXPLANATION in features
+        extractors = _feature_extractors(self._features)
+        self._columns: List[str] = [
+            name
+            for column, _ in extractors
+            # Also expose the plain contents as text, e.g., for re-rankers.
+            for name in (
+                ("text", column)
+                if column == "contents_plain"
+                else (column,)
+            )
+        ]
+        self._extractors: List[Tuple[str, Callable[[Result], Any]]] = [
+            (column, extract)
+            for column, extract in extractors
+            if extract not in _CONTENTS_EXTRACTORS
+        ]
+        self._contents_extractors: List[
+            Tuple[str, Callable[[Result], Any]]
+        ] = [
+            (column, extract)
+            for column, extract in extractors
+            if extract in _CONTENTS_EXTRACTORS
+        ]
+
+        # Only parameters that change the retrieved results key the cache.
+        self._results_key: Tuple[Any, ...] = self._results_parameters()
+        # Note that changing parameters also changes the hash, so the retriever
+        # should not be modified while being used as a key in a dict or set.
+        self._hash: int = hash(self._parameters())
+
+    def _fetch_contents(
+        self,
+        results: List[Result],
+        requests: BoundedSemaphore,
+        executor: Optional[ThreadPoolExecutor],
+    ) -> Dict[str, List[Any]]:
+        if executor is None:
+            return {
+                column: [
+                    _fetch(requests, extract, result)
+                    for result in results
+                ]
+                for column, extract in self._contents_extractors
+            }
+
+        # Fetch contents concurrently, as each needs a separate request.
+        contents: List[Tuple[str, List["Future[Any]"]]] = [
+            (column, [
+                executor.submit(_fetch, requests, extract, result)
+                for result in results
+            ])
+            for column, extract in self._contents_extractors
+        ]
+        return {
+            column: [future.result() for future in futures]
+            for column, futures in contents
+        }
 
+    def _search(self, query: str) -> Iterable[Union[
+        Result, ExplainedResult,
+    ]]:
         results: Iterable[Union[
             Result, ExplainedResult,
         ]]
         if not self.phrases:
-            if explain:
+            if self._explain:
                 results = search(
                     query=query,
                     index=self.index,
                     minimal=False,
                     explain=True,
                     extended_meta=False,
-                    page_size=page_size,
+                    page_size=self._page_size,
                     retries=self.retries,
                     backoff_seconds=self.backoff_seconds,
                     api_key=self.api_key,
@@ -146,14 +314,14 @@ class ChatNoirRetrieve(Transformer):
                     minimal=False,
                     explain=False,
                     extended_meta=False,
-                    page_size=page_size,
+                    page_size=self._page_size,
                     retries=self.retries,
                     backoff_seconds=self.backoff_seconds,
                     api_key=self.api_key,
                     search_method=self.search_method
                 ).results
         else:
-            if explain:
+            if self._explain:
                 results = search_phrases(
                     query=query,
                     index=self.index,
@@ -161,7 +329,7 @@ class ChatNoirRetrieve(Transformer):
                     slop=self.slop,
                     explain=True,
                     extended_meta=False,
-                    page_size=page_size,
+                    page_size=self._page_size,
                     retries=self.retries,
                     backoff_seconds=self.backoff_seconds,
                     api_key=self.api_key,
@@ -175,29 +343,170 @@ class ChatNoirRetrieve(Transformer):
                     slop=self.slop,
                     explain=False,
                     extended_meta=False,
-                    page_size=page_size,
+                    page_size=self._page_size,
                     retries=self.retries,
                     backoff_seconds=self.backoff_seconds,
                     api_key=self.api_key,
                     search_method=self.search_method
                 ).results
+        return results
 
-        if self.filter_unknown:
-            # Filter unknown results, i.e., when the TREC ID is missing.
-            results = (
-                result
-                for result in results
-                if result.trec_id is not None
+    def _retrieve(
+        self,
+        query: str,
+        requests: BoundedSemaphore,
+        contents_executor: Optional[ThreadPoolExecutor],
+    ) -> Dict[str, List[Any]]:
+        extractors = self._extractors
+        columns: Dict[str, List[Any]] = {
+            column: []
+            for column in self._columns
+        }
+        contents_results: List[Result] = []
+        num_results = 0
+        # Hold a request slot while loading the result pages.
+        with requests:
+            for result in self._search(query):
+                if num_results == self.num_results:
+                    # No results requested at all.
+                    break
+                if self.filter_unknown and result.trec_id is None:
+                    # Filter unknown results, i.e., when the TREC ID is missing.
+                    continue
+                for column, extract in extractors:
+                    columns[column].append(extract(result))
+                if self._contents_extractors:
+                    contents_results.append(result)
+                num_results += 1
+                if num_results == self.num_results:
+                    # Stop before loading further result pages.
+                    break
+        if self._contents_extractors:
+            columns.update(self._fetch_contents(
+                contents_results,
+                requests,
+                contents_executor,
+            ))
+        if "text" in columns:
+            columns["text"] = columns["contents_plain"]
+        return columns
+
+    def _retrieve_cached(
+        self,
+        query: str,
+        requests: BoundedSemaphore,
+        contents_executor: Optional[ThreadPoolExecutor],
+    ) -> Dict[str, List[Any]]:
+        if self.cache_size == 0:
+            return self._retrieve(query, requests, contents_executor)
+
+        # Include the result parameters in the cache key, so that changing
+        # a parameter (e.g., during a grid search) never returns stale results.
+        key = (self._results_key, query)
+        cache = self._cache
+        with self._cache_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+
+        columns = self._retrieve(query, requests, contents_executor)
+        with self._cache_lock:
+            cache[key] = columns
+            cache.move_to_end(key)
+            if self.cache_size is not None and len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return columns
+
+    def _transform_query(
+        self,
+        topic: DataFrame,
+        requests: BoundedSemaphore,
+        contents_executor: Optional[ThreadPoolExecutor],
+    ) -> Dict[str, Iterable[Any]]:
+        if topic.shape[0] != 1:
+            raise RuntimeError("Can only transform one query at a time.")
+
+        row: Dict[str, Any] = {
+            column: topic[column].iat[0]
+            for column in topic.columns
+        }
+        query: str = row["query"]
+
+        columns: Dict[str, List[Any]] = self._retrieve_cached(
+            query,
+            requests,
+            contents_executor,
+        )
+        num_results = len(columns["docno"])
+
+        return {
+            **{
+                column: repeat(value, num_results)
+                for column, value in row.items()
+            },
+            **columns,
+        }
+
+    def _transform_queries(
+        self,
+        topics: DataFrame,
+    ) -> Iterator[Dict[str, Iterable[Any]]]:
+        # Limit concurrent requests to ChatNoir across all queries.
+        requests = BoundedSemaphore(max(self.max_workers, 1))
+        contents_executor: Optional[ThreadPoolExecutor] = None
+        if self.max_workers > 1 and self._contents_extractors:
+            contents_executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
             )
-            pass
+        try:
+            yield from self._transform_queries_with(
+                topics,
+                requests,
+                contents_executor,
+            )
+        finally:
+            if contents_executor is not None:
+                contents_executor.shutdown()
 
-        if self.num_results is not None:
-            results = islice(results, self.num_results)
+    def _transform_queries_with(
+        self,
+        topics: DataFrame,
+        requests: BoundedSemaphore,
+        contents_executor: Optional[ThreadPoolExecutor],
+    ) -> Iterator[Dict[str, Iterable[Any]]]:
+        if len(topics) == 1:
+            # Search a single query directly, without starting threads.
+            yield self._transform_query(topics, requests, contents_executor)
+            return
 
-        return DataFrame([
-            self._merge_result(row, result)
-            for result in results
-        ])
+        topics_by_query: List[DataFrame] = [
+            topics.iloc[[i]]
+            for i in range(len(topics))
+        ]
+        if self.max_workers <= 1:
+            # Search queries sequentially in the current thread.
+            for topic in topics_by_query:
+                yield self._transform_query(topic, requests, contents_executor)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Search queries concurrently, as searching is I/O-bound.
+            futures: List["Future[Dict[str, Iterable[Any]]]"] = [
+                executor.submit(
+                    self._transform_query,
+                    topic,
+                    requests,
+                    contents_executor,
+                )
+                for topic in topics_by_query
+            ]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                # Don't wait for pending searches if a search failed.
+                for future in futures:
+                    future.cancel()
 
     def transform(self, topics: DataFrame) -> DataFrame:
 
@@ -207,55 +516,98 @@ class ChatNoirRetrieve(Transformer):
         if not {'qid', 'query'}.issubset(topics.columns):
             raise RuntimeError("Needs qid and query columns.")
 
-        if len(topics) == 0:
-            return self._transform_query(topics)
+        if topics["qid"].duplicated().any():
+            raise RuntimeError("Can only transform one query per qid.")
 
-        topics_by_query: DataFrameGroupBy = topics.groupby(
-            by=["qid"],
-            as_index=False,
-            sort=False,
-        )
+        if len(topics) == 0:
+            # Nothing to search for.
+            return DataFrame(columns=list(dict.fromkeys([
+                *topics.columns, "docno", "score", "rank",
+            ])))
 
-        retrieved: DataFrame
+        retrieved_by_query: Iterable[Dict[str, Iterable[Any]]] = \
+            self._transform_queries(topics)
         if self.verbose:
-            # Show progress during reranking queries.
-            tqdm.pandas(
+            # Show progress during searching queries.
+            retrieved_by_query = tqdm(
+                retrieved_by_query,
                 desc="Searching with ChatNoir",
                 unit="query",
+                total=len(topics),
             )
-            retrieved = topics_by_query.progress_apply(
-                self._transform_query
-            )
-        else:
-            retrieved = topics_by_query.apply(self._transform_query)
+
+        # Collect all queries' results column-wise
+        # to construct the data frame only once.
+        columns: Dict[str, List[Any]] = {}
+        for retrieved_columns in retrieved_by_query:
+            for column, values in retrieved_columns.items():
+                columns.setdefault(column, []).extend(values)
+        column_dtypes: Dict[str, str] = (
+            _COMPACT_COLUMN_DTYPES
+            if self.compact_dtypes
+            else _COLUMN_DTYPES
+        )
+        retrieved = DataFrame({
+            column: Series(values, dtype=column_dtypes.get(column))
+            for column, values in columns.items()
+        })
 
         if len(retrieved) == 0:
+            retrieved["rank"] = Series(dtype="int64")
+            return retrieved
+        if len(topics) == 1:
+            # Rank a single query's results without grouping.
+            retrieved = retrieved.sort_values(
+                by="score",
+                ascending=False,
+                kind="stable",
+                ignore_index=True,
+            )
+            retrieved["rank"] = range(FIRST_RANK, FIRST_RANK + len(retrieved))
             return retrieved
-        retrieved = retrieved.reset_index(drop=True)\
-            .sort_values(by=["score"], ascending=False)
-        retrieved = add_ranks(retrieved)
+        retrieved = retrieved.sort_values(
+            by=["qid", "score"],
+            ascending=[True, False],
+            kind="stable",
+            ignore_index=True,
+        )
+        # Results are sorted by score per query, so ranks just count up.
+        retrieved["rank"] = retrieved.groupby(
+            by="qid",
+            sort=False,
+        ).cumcount() + FIRST_RANK
 
         return retrieved
 
-    def __hash__(self):
-        return hash((
+    def _results_parameters(self) -> Tuple[Any, ...]:
+        return (
+            self.api_key,
+            self._index,
+            self.phrases,
+            self.slop,
+            self._features,
+            self.filter_unknown,
+            self.num_results,
+            self.page_size,
+            self.search_method,
+        )
+
+    def _parameters(self) -> Tuple[Any, ...]:
+        return (
             self.api_key,
-            (
-                tuple(sorted(self.index))
-                if isinstance(self.index, Set)
-                else self.index
-            ),
+            self._index,
             self.phrases,
             self.slop,
-            (
-                list(sorted(self.features))
-                if isinstance(self.features, Set)
-                else self.features
-            ),
+            self._features,
             self.filter_unknown,
             self.num_results,
             self.page_size,
             self.retries,
             self.backoff_seconds,
             self.verbose,
-        ))
+            self.search_method,
+            self.compact_dtypes,
+        )
+
+    def __hash__(self):
+        return self._hash
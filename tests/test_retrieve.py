@@ -1,6 +1,17 @@
+from functools import partial
+from pickle import dumps, loads
+from threading import Lock
+from time import sleep
+from types import SimpleNamespace
+from typing import Any, List
+
 from chatnoir_api import Index
-from pandas import DataFrame
+from pandas import DataFrame, StringDtype
+from pandas.testing import assert_frame_equal
+from pyterrier.model import FIRST_RANK
+from pytest import MonkeyPatch, mark, raises
 
+from chatnoir_pyterrier import retrieve as retrieve_module
 from chatnoir_pyterrier.retrieve import ChatNoirRetrieve, Feature
 
 
@@ -12,6 +23,201 @@ def test_retrieve_hash(api_key: str):
     assert isinstance(retrieve_hash, int)
 
 
+def test_retrieve_empty(api_key: str):
+    retrieve = ChatNoirRetrieve(
+        api_key=api_key,
+    )
+    result = retrieve.transform(DataFrame(columns=["qid", "query"]))
+    assert result is not None
+    assert isinstance(result, DataFrame)
+    assert len(result) == 0
+    assert "qid" in result.columns
+    assert "query" in result.columns
+    assert "docno" in result.columns
+    assert "score" in result.columns
+    assert "rank" in result.columns
+
+
+def test_retrieve_no_results(api_key: str, query: str):
+    retrieve = ChatNoirRetrieve(
+        api_key=api_key,
+        num_results=0,
+    )
+    result = retrieve.search(query)
+    assert result is not None
+    assert isinstance(result, DataFrame)
+    assert len(result) == 0
+    assert "docno" in result.columns
+    assert "score" in result.columns
+    assert "rank" in result.columns
+
+
+def test_retrieve_duplicate_qid(api_key: str):
+    retrieve = ChatNoirRetrieve(
+        api_key=api_key,
+    )
+    with raises(RuntimeError):
+        retrieve.transform(DataFrame({
+            "qid": ["1", "1"],
+            "query": ["python library", "search engine"],
+        }))
+
+
+def _search_results(num_results: int) -> SimpleNamespace:
+    return SimpleNamespace(results=[
+        SimpleNamespace(trec_id=f"doc-{i}", score=float(num_results - i))
+        for i in range(num_results)
+    ])
+
+
+def test_retrieve_cache(monkeypatch: MonkeyPatch):
+    queries: List[str] = []
+
+    def search(query: str, **kwargs: Any) -> SimpleNamespace:
+        queries.append(query)
+        return _search_results(10)
+
+    monkeypatch.setattr(retrieve_module, "search", search)
+    retrieve = ChatNoirRetrieve(
+        num_results=3,
+        cache_size=10,
+    )
+    result = retrieve.search("python library")
+    cached_result = retrieve.search("python library")
+    assert_frame_equal(result, cached_result)
+    assert queries == ["python library"]
+
+    # Parameters that don't change the results still hit the cache.
+    retrieve.verbose = True
+    retrieve.compact_dtypes = True
+    retrieve.search("python library")
+    assert queries == ["python library"]
+
+    # Changed parameters must not return stale results.
+    retrieve.verbose = False
+    retrieve.compact_dtypes = False
+    retrieve.num_results = 2
+    result = retrieve.search("python library")
+    assert len(result) == 2
+    assert queries == ["python library", "python library"]
+
+    # Unpickled retrievers start with an empty cache.
+    unpickled_retrieve = loads(dumps(retrieve))
+    assert unpickled_retrieve == retrieve
+    assert hash(unpickled_retrieve) == hash(retrieve)
+    assert_frame_equal(unpickled_retrieve.search("python library"), result)
+    assert queries == ["python library"] * 3
+
+
+def test_retrieve_compact_dtypes(api_key: str, query: str):
+    retrieve = ChatNoirRetrieve(
+        api_key=api_key,
+        num_results=1,
+        compact_dtypes=True,
+    )
+    result = retrieve.search(query)
+    assert result is not None
+    assert isinstance(result, DataFrame)
+    assert result["score"].dtype == "float32"
+    assert isinstance(result["docno"].dtype, StringDtype)
+
+
+def test_retrieve_sequential(api_key: str):
+    topics = DataFrame({
+        "qid": ["1", "2"],
+        "query": ["python library", "search engine"],
+    })
+    retrieve = ChatNoirRetrieve(
+        api_key=api_key,
+        num_results=3,
+    )
+    retrieve_sequential = ChatNoirRetrieve(
+        api_key=api_key,
+        num_results=3,
+        max_workers=1,
+    )
+    result = retrieve.transform(topics)
+    result_sequential = retrieve_sequential.transform(topics)
+    assert_frame_equal(result, result_sequential)
+
+
+def test_retrieve_ranks(api_key: str):
+    topics = DataFrame({
+        "qid": ["1", "2"],
+        "query": ["python library", "search engine"],
+    })
+    retrieve = ChatNoirRetrieve(
+        api_key=api_key,
+        num_results=3,
+    )
+    result = retrieve.transform(topics)
+    assert result is not None
+    assert isinstance(result, DataFrame)
+    assert len(result) > 0
+
+    qids = list(result["qid"])
+    # Rows of each query are contiguous.
+    assert qids == sorted(qids, key=qids.index)
+    for _, group in result.groupby("qid"):
+        assert list(group["rank"]) == list(
+            range(FIRST_RANK, FIRST_RANK + len(group))
+        )
+
+
+@mark.parametrize("max_workers", [1, 3, 10])
+def test_retrieve_contents_concurrency(
+    monkeypatch: MonkeyPatch,
+    max_workers: int,
+):
+    lock = Lock()
+    requests = 0
+    max_requests = 0
+
+    def request() -> None:
+        nonlocal requests, max_requests
+        with lock:
+            requests += 1
+            max_requests = max(max_requests, requests)
+        sleep(0.001)
+        with lock:
+            requests -= 1
+
+    def cache_contents(trec_id: str, plain: bool) -> str:
+        request()
+        return f"contents of {trec_id}"
+
+    def search(query: str, **kwargs: Any) -> SimpleNamespace:
+        request()
+        results = _search_results(5).results
+        for result in results:
+            result.trec_id = f"{query}-{result.trec_id}"
+            result.cache_contents = partial(cache_contents, result.trec_id)
+        return SimpleNamespace(results=results)
+
+    monkeypatch.setattr(retrieve_module, "search", search)
+    retrieve = ChatNoirRetrieve(
+        features=Feature.CONTENTS_PLAIN,
+        num_results=5,
+        max_workers=max_workers,
+    )
+    topics = DataFrame({
+        "qid": [str(i) for i in range(20)],
+        "query": [f"query {i}" for i in range(20)],
+    })
+    result = retrieve.transform(topics)
+    assert len(result) == 100
+    assert max_requests <= max_workers
+    for _, group in result.groupby("qid"):
+        assert list(group["docno"]) == [
+            f"{group['query'].iat[0]}-doc-{i}"
+            for i in range(5)
+        ]
+    assert list(result["contents_plain"]) == [
+        f"contents of {docno}"
+        for docno in result["docno"]
+    ]
+
+
 def test_retrieve_query(api_key: str, query: str, index: Index):
     retrieve = ChatNoirRetrieve(
         api_key=api_key,